@@ -25,25 +25,24 @@ INPUT:
 OUTPUT:
     Results saved in ../Results/constant/ folder
         - Rainfall Hazard: Rainfall hazard class in .tif format. Saved as: ./RainHazard/{}_RainHazard.tif
+                            Not saved if SAVE_RAIN_HAZARD is False.
         - Hazard map: in .tif format. Saved as: ./Hazard/{}_Hazard.tif
 
 Rosa M Palau (NGI)            08.08.2024
 """
 import numpy as np
 import rasterio
-import rioxarray
-import xarray as xr
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+from affine import Affine
 
-#import geojson
-#import json
-#from shapely.geometry import shape, mapping, Point, LineString
-#from shapely.ops import unary_union
+import os
+import hashlib
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 
-from pyproj import Proj, Transformer
-
-from pathlib import Path
-
-from HazardProcessor import HazardProcessor
+from HazardProcessor import HazardProcessor, NODATA, NUMBA_AVAILABLE, _hazard_kernel
 
 ## Define input parameters
 KWARGS = {
@@ -52,307 +51,521 @@ KWARGS = {
     "epsg_wgs84": 4326,
     'MULTIPROCESSING': False,
     'MAX_NUMBER_OF_PROCESSES': 10,
+    'OVERVIEW_LEVEL': 1, # >1 computes the hazard on a grid OVERVIEW_LEVEL times coarser than the susc map
+    'SAVE_RAIN_HAZARD': True, # False: only the hazard map is saved
+    'PROFILE': False, # True: profile the run, stats saved in ../Results/profile_{pid}.prof (one per worker with MULTIPROCESSING)
+    'COG': False, # True: save the outputs as Cloud-Optimized GeoTIFFs (requires rio-cogeo)
+    'SKIP_UP_TO_DATE': False, # True: skip maps whose outputs are newer than all input files
+}
+
+# Profile of the output rasters: tiled and compressed. Hazard classes fit in a byte.
+OUT_PROFILE = {
+    "driver": "GTiff",
+    "dtype": "uint8",
+    "nodata": NODATA,
+    "tiled": True,
+    "blockxsize": 512,
+    "blockysize": 512,
+    "compress": "LZW",
+    "predictor": 2,
+    "BIGTIFF": "IF_SAFER",
 }
 
+# Hazard matrix. Rows: susceptibility class, columns: rainfall hazard class (0-5).
+# Can be replaced by passing HAZARD_LUT to CalcHazard.
+HAZARD_LUT = np.array([[0, 0, 0, 0, 0, 0],
+                       [0, 0, 0, 0, 0, 0],
+                       [0, 0, 1, 2, 3, 5],
+                       [0, 0, 2, 3, 5, 10],
+                       [0, 0, 3, 5, 10, 15],
+                       [0, 0, 5, 10, 15, 20]], dtype = np.uint8)
+
 class CalcHazard(HazardProcessor):
     def __init__(self, **kwargs):
+        # Decimation of the susc map (1: full resolution)
+        self.OVERVIEW_LEVEL = kwargs.get('OVERVIEW_LEVEL', 1)
+        # Save the rainfall hazard map (intermediate result)
+        self.SAVE_RAIN_HAZARD = kwargs.get('SAVE_RAIN_HAZARD', True)
+        # Hazard matrix
+        self.LUT = np.ascontiguousarray(kwargs.get('HAZARD_LUT', HAZARD_LUT), dtype = np.uint8)
+        # One column per rainfall hazard class: 0 (no data) and 1 to len(I_lim) + 1
+        if self.LUT.ndim != 2 or self.LUT.shape[1] < len(kwargs["I_lim"]) + 2:
+            raise ValueError("HAZARD_LUT must be a 2D array with at least {} columns, got shape {}".format(
+                len(kwargs["I_lim"]) + 2, self.LUT.shape))
+
         super().__init__(**kwargs)
         
-    def read_raster(self, path_map):
+    def _ensure_overviews(self, path_map):
         """
-        Implements rasterio open to read a raster map. Saves variables which are interesting 
+        Builds overviews (external .ovr file) of a susceptibility map if it has none, so that
+        coarser reads do not need to decode the full resolution raster. The .tif is not modified.
             INPUT: 
                 -path_map: file of the susceptibility map
         """
-        # function to read raster maps with rasterio
-        
-        with rasterio.open(path_map) as src_dataset:
-            print("Reading data: {}".format(path_map))
-            kwds = src_dataset.profile
-            features_in = src_dataset.read(1, masked = True).astype(float).filled(np.nan)
-            bbox = src_dataset.bounds
-
-            top = bbox.top
-            bottom = bbox.bottom
-            left = bbox.left
-            right = bbox.right
-
-        ncols = kwds["width"]
-        nrows = kwds["height"]
+        with rasterio.Env(TIFF_USE_OVR = True):
+            with rasterio.open(path_map) as src_dataset:
+                if src_dataset.overviews(1):
+                    return
+            
+            print("Building overviews: {}".format(path_map))
+            with rasterio.open(path_map, "r+") as dst_dataset:
+                # mode resampling, the susceptibility is a class
+                dst_dataset.build_overviews([2, 4, 8, 16], Resampling.mode)
         
-        return(features_in, ncols, nrows, kwds, bbox)
-    
-    def read_susceptibility_classified(self, file_susc):
+    def read_raster(self, src_dataset, window=None):
         """
-        Reads susceptibility map using rasterio.
-        Converts into xarray
+        Implements rasterio read of a window of an opened raster map as float32. 
+        No data values are set as np.nan.
             INPUT: 
-                -file_susc: file of the susceptibility map
+                -src_dataset: opened raster map (rasterio dataset or WarpedVRT)
+                -window: rasterio Window to read. The whole raster is read if None.
         """
+        features_in = src_dataset.read(1, window = window, out_dtype = np.float32)
         
-        # read raster
-        susc_class, ncols, nrows, kwds, bbox = self.read_raster(file_susc)
-        dx = kwds["transform"][0]
-        
-        crs = kwds["crs"]
-        nodata = kwds["nodata"]
-        transform = kwds["transform"]
-        
-        # Create coordinate arrays using bounding box
-        x_coords = np.linspace(bbox.left, bbox.right, num = ncols)
-        y_coords = np.linspace(bbox.top, bbox.bottom, num = nrows)
-        
-        # Convert the raster data to xarray DataArray
-        susc_da = xr.DataArray(susc_class, coords=[('y', y_coords), ('x', x_coords)])
+        nodata = src_dataset.nodata
+        if nodata is not None and not np.isnan(nodata):
+            features_in[features_in == nodata] = np.nan
         
-        # Assign CRS and nodata value to the DataArray attributes
-        susc_da.attrs['crs'] = crs
-        susc_da.attrs['nodata'] = nodata
-        susc_da.attrs["_FillValue"] = np.nan
-
-        return(susc_da, ncols, nrows, kwds, bbox, dx, crs) 
-        
-    def OpenRainNorm(self, susc_da, crs_susc):#(self, susc_da, bbox_susc, ncols_susc, nrows_susc, dx_susc, kwds_susc):
+        return(features_in)
+    
+    def OpenMatchedRaster(self, src_dataset, kwds):
+        """
+        Opens a raster as a virtual raster reprojected and resampled (nearest) to the output grid,
+        so that it can be read with the same windows as the outputs.
+        Rasters without crs information (.asc) are assumed to have the crs of the susc map.
+            INPUT:
+                -src_dataset: opened raster map
+                -kwds: profile of the output grid
+        """
+        vrt = WarpedVRT(src_dataset,
+                        src_crs = src_dataset.crs or kwds["crs"],
+                        crs = kwds["crs"],
+                        transform = kwds["transform"],
+                        width = kwds["width"],
+                        height = kwds["height"],
+                        resampling = Resampling.nearest,
+                        nodata = np.nan,
+                        dtype = "float32")
+        
+        return(vrt)
+        
+    def _build_rain_cache(self, file_in, kwds):
+        """
+        Reprojects a raster to the output grid once and saves it as a float32 .npy file in the 
+        ../Data/.cache/ folder. The file name depends on the grid and on the raster file, so the
+        cache is rebuilt if any of them changes. The raster is reprojected and written strip by 
+        strip, and older versions of the cache for the same grid are removed. Returns the path of
+        the .npy file.
+            INPUT:
+                -file_in: file of the raster
+                -kwds: profile of the output grid
+        """
+        key_grid = repr((kwds["crs"].to_wkt(), tuple(kwds["transform"]), kwds["width"], kwds["height"]))
+        digest_grid = hashlib.blake2b(key_grid.encode(), digest_size = 8).hexdigest()
+        stat = os.stat(file_in)
+        key_file = repr((str(file_in), stat.st_size, stat.st_mtime_ns))
+        digest_file = hashlib.blake2b(key_file.encode(), digest_size = 8).hexdigest()
+        
+        folder_cache = self.path_data / ".cache"
+        file_cache = folder_cache / "{}_{}_{}.npy".format(file_in.stem, digest_grid, digest_file)
+        if not file_cache.exists():
+            folder_cache.mkdir(parents=True, exist_ok=True)
+            
+            # Written to a temporary file first, other processes may build the same cache.
+            # The raster is opened here, so that the cache holds the current version of the file.
+            file_tmp = file_cache.with_suffix(".{}.tmp".format(os.getpid()))
+            with rasterio.open(file_in) as src_dataset, self.OpenMatchedRaster(src_dataset, kwds) as vrt:
+                self._save_npy_by_strips(file_tmp, (kwds["height"], kwds["width"]), np.float32,
+                                         lambda window: self.read_raster(vrt, window))
+            os.replace(file_tmp, file_cache)
+            # Older versions of the raster on this grid. Other grids are kept, they may still be
+            # used by other tiles of the same run.
+            self._remove_stale_cache(file_cache, 
+                                     "{}_{}_{}.npy".format(file_in.stem, digest_grid, "?" * len(digest_file)))
+        
+        return(file_cache)
+    
+    def OpenRainNorm(self, kwds):
         """
         Opens rainfall data that is required for the normalization of the rain.
-        Reprojects, cuts and resamples the raster to cover the area of the susc map.
+        Reprojects, cuts and resamples the raster to cover the area of the susc map. The result
+        is cached (see _build_rain_cache) and opened as a read-only memory-mapped array, so that 
+        the rasters are only parsed and reprojected the first time a grid is processed.
             INPUT: 
-                -bbox_susc: bounding box of susceptibility map
-                -ncols_susc, nrows_susc: umber of columns and number of rows of susc map
+                -kwds: profile of the output grid
         """
         
         # files to read
         file_mean_day_rain = self.path_data / "MeanMaxDayRain.asc"
         file_std_day_rain = self.path_data / "StdMaxDayRain.txt"
-
-        
-        # read rasters
-        rioxarray.set_options(export_grid_mapping = True)
-        MeanRain = rioxarray.open_rasterio(file_mean_day_rain)
-        StdRain = rioxarray.open_rasterio(file_std_day_rain)
-        
-        # Make sure we have crs information
-        MeanRain.rio.write_crs(crs_susc, inplace = True) # Write crs in data array (.asc don't have crs)
-        StdRain.rio.write_crs(crs_susc, inplace = True) # Write crs in data array (.asc don't have crs)
         
-        # Reproject MeanRain/StdRain object to match the resolution, projection, and region of susc_da.
-        repr_mean = MeanRain.rio.reproject_match(susc_da)
-        repr_std  = StdRain.rio.reproject_match(susc_da)
+        # open rasters matched to the susc map
+        MeanRain = np.load(self._build_rain_cache(file_mean_day_rain, kwds), mmap_mode = "r")
+        StdRain = np.load(self._build_rain_cache(file_std_day_rain, kwds), mmap_mode = "r")
         
-        # Get only values (array)
-        repr_mean = repr_mean.isel(band=0).values
-        repr_std  = repr_std.isel(band=0).values
-        
-        return(repr_mean, repr_std)
+        return(MeanRain, StdRain)
         
     
     def CreateCntRain(self, ncols, nrows):
         """
-        Creates am empty array like the input-susceptibility map filled with constant user-defined
-        24 h rainfall acummmulation value. 
+        Creates an array like the input-susceptibility map with constant user-defined
+        24 h rainfall acummmulation value. The array is a read-only broadcast view of the 
+        scalar self.in_acum, no memory is allocated for it.
             INPUT: 
                 -ncols, nrows: number of columns and number of rows 
         """
-        acum24 = np.full((nrows, ncols), self.in_acum)
+        acum24 = np.broadcast_to(self.in_acum, (nrows, ncols))
         return(acum24)
 
 
-    def ReadInRainMap(self, susc_da, crs_susc):
+    def ReadInRainMap(self, kwds):
         """
         Opens provided maps with 24h rainfall acumulations.
-        Clips and resamples rainfall to the extent of susc map. 
+        Clips and resamples rainfall to the extent of susc map. The result is cached and opened
+        as a read-only memory-mapped array.
             INPUT: 
-                -bbox_susc: bounding box of susceptibility map
-                -ncols_susc, nrows_susc: umber of columns and number of rows of susc map
+                -kwds: profile of the output grid
         """
         nameinfile = self.name_in_rain + ".tif"
         file_in_rain = self.path_data / nameinfile
         
-        rioxarray.set_options(export_grid_mapping = True)
-        acum24 = rioxarray.open_rasterio(file_in_rain)
-        
-        # Reproject acum24h object to match the resolution, projection, and region of susc_da.
-        repr_acum24 = acum24.rio.reproject_match(susc_da)
-        
-        # Get only values (array)
-        repr_acum24 = repr_acum24.isel(band=0).values
-        
-        # Make sure nan values are set as np.nan (no negative rainfall acummulations).
-        repr_acum24 = np.where(repr_acum24 < 0, np.nan, repr_acum24)
+        # open raster matched to the susc map, reprojected once per grid (see _build_rain_cache)
+        acum24 = np.load(self._build_rain_cache(file_in_rain, kwds), mmap_mode = "r")
         
-        return(repr_acum24)
+        return(acum24)
 
 
-    def ComputeRainCnt(self, MeanRain, StdRain, acum24):
+    def ComputeRainCnt(self, MeanRain, StdRain, acum24, out=None):
         """
         Normalizes 24h rainfall acummulations.
             INPUT:
                 - MeanRain: array with mean of the 24h rainfall acummulations over area.
                 - StdRain: array with standard deviation of 24h rainfall acummulations over area.
                 - acum24: array with the event 24h rainfall acummulations 
+                - out: (optional) float32 array where the result is stored. Can be acum24 itself,
+                    which is then overwritten. A new array is allocated if None.
     
         """
-        # Normalize
-        I24norm_da = (acum24-MeanRain)/StdRain
+        # Normalize, without intermediate arrays
+        I24norm_da = np.subtract(acum24, MeanRain, out = out)
+        np.divide(I24norm_da, StdRain, out = I24norm_da)
         
         return(I24norm_da)
     
-    def ComputeRainHazard(self, I24norm_da, I_lim, file_name1, ncols, nrows, kwds):
+    def ComputeRainHazard(self, I24norm_da, I_lim, nan_mask=None, out=None):
         """
         Implements computation of the rainfall hazard.
             INPUT: 
                 -I24norm_da, normalized rainfall map array 
-                -I_lim: input array with limits of the rainfall hazard classes
-                -file_name1, input name of he susceptibility map sheet
-                -ncols, nrows: number of columns and number of rows
-                -kwds
+                -I_lim: input float32 array with limits of the rainfall hazard classes
+                -nan_mask, (optional) boolean array, True where I24norm_da is nan. 
+                    Computed if not given.
+                -out: (optional) uint8 array with the shape of I24norm_da where the result is
+                    stored. A new array is allocated if None.
         """
         
         aux = I24norm_da # raster array
-        #time_coord = aux.time
-        
-        RainHazard_aux = np.zeros_like(aux)
-        
-        # Assign rain hazard
-        for ii in range(len(I_lim)): 
-            if ii == 0:
-                mask = (aux <= ii)
-                RainHazard_aux = np.where(mask, ii + 1, RainHazard_aux)
-            else:
-                if ii < 3:
-                    mask = (aux <= ii) & (aux > ii-1)
-                    RainHazard_aux = np.where(mask, ii + 1, RainHazard_aux)
-                else:
-                    mask = (aux <= ii) & (aux > ii-1)
-                    RainHazard_aux = np.where(mask, ii + 1, RainHazard_aux)
-                    
-                    mask = (aux > ii)
-                    RainHazard_aux = np.where(mask, ii + 2, RainHazard_aux)
-        
-        # Save to file
-        folder_out = self.path_out / self.mode
-        if not folder_out.exists(): # Create the folder if it doesn't exist
-            folder_out.mkdir(parents=True, exist_ok=True)
-        
-        folder_out = self.path_out / self.mode / "RainHazard"
-        if not folder_out.exists(): # Create the folder if it doesn't exist
-            folder_out.mkdir(parents=True, exist_ok=True)
-            
-        prefix = file_name1.split('_')[0]
-            
-        file_save_name = prefix + "_RainHazard.tif"
-        file_save = folder_out / file_save_name
+        if nan_mask is None:
+            nan_mask = np.isnan(aux)
         
-        # Save Rain Hazard raster
-        outfile = file_save
-        with rasterio.open(outfile, "w", **kwds) as dst_dataset:
-            dst_dataset.write(RainHazard_aux, 1)
+        # Assign rain hazard: class ii + 1 for I_lim[ii-1] < aux <= I_lim[ii]
+        RainHazard_aux = np.empty(aux.shape, dtype = np.uint8) if out is None else out
+        np.add(np.searchsorted(I_lim, aux, side = "left"), 1,
+               out = RainHazard_aux, casting = "unsafe")
+        RainHazard_aux[nan_mask] = NODATA
         
         return(RainHazard_aux)
     
-    def ComputeHazard(self, susc_da, RainHazard_aux, file_name1, kwds):
+    def ComputeHazard(self, susc_da, RainHazard_aux, nan_mask=None):
         """
         Implements computation of the hazard matrix.
             INPUT: 
-                -susc_da, Susceptibility map array 
-                -RainHazard_aux, rainfall hazard array
-                -file_name1, input name of he susceptibility map sheet
-                -kwds
+                -susc_da, Susceptibility map array (any dtype)
+                -RainHazard_aux, uint8 rainfall hazard array (NODATA if no data)
+                -nan_mask, (optional) boolean array, True where susc_da is no data. 
+                    Computed (nan cells) if not given. Susceptibility values outside the rows 
+                    of the hazard matrix are always treated as no data.
         """
         
-        # Hazard matrix
-        hazard_aux = np.zeros_like(susc_da) # initialise array to store the hazard
-        
-        # Check hazard by going through hazard matrix
-        hazard_aux = np.where(np.isnan(susc_da), np.nan, hazard_aux)
-        
-        mask = (susc_da == 2) & (RainHazard_aux == 2)
-        hazard_aux = np.where(mask, 1, hazard_aux)
-        mask = (susc_da == 2) & (RainHazard_aux == 3)
-        hazard_aux = np.where(mask, 2, hazard_aux)
-        mask = (susc_da == 2) & (RainHazard_aux == 4)
-        hazard_aux = np.where(mask, 3, hazard_aux)
-        mask = (susc_da == 2) & (RainHazard_aux == 5)
-        hazard_aux = np.where(mask, 5, hazard_aux)
-        
-        mask = (susc_da == 3) & (RainHazard_aux == 2)
-        hazard_aux = np.where(mask, 2, hazard_aux)
-        mask = (susc_da == 3) & (RainHazard_aux == 3)
-        hazard_aux = np.where(mask, 3, hazard_aux)
-        mask = (susc_da == 3) & (RainHazard_aux == 4)
-        hazard_aux = np.where(mask, 5, hazard_aux)
-        mask = (susc_da == 3) & (RainHazard_aux == 5)
-        hazard_aux = np.where(mask, 10, hazard_aux)
-        
-        mask = (susc_da == 4) & (RainHazard_aux == 2)
-        hazard_aux = np.where(mask, 3, hazard_aux)
-        mask = (susc_da == 4) & (RainHazard_aux == 3)
-        hazard_aux = np.where(mask, 5, hazard_aux)
-        mask = (susc_da == 4) & (RainHazard_aux == 4)
-        hazard_aux = np.where(mask, 10, hazard_aux)
-        mask = (susc_da == 4) & (RainHazard_aux == 5)
-        hazard_aux = np.where(mask, 15, hazard_aux)
-        
-        mask = (susc_da == 5) & (RainHazard_aux == 2)
-        hazard_aux = np.where(mask, 5, hazard_aux)
-        mask = (susc_da == 5) & (RainHazard_aux == 3)
-        hazard_aux = np.where(mask, 10, hazard_aux)
-        mask = (susc_da == 5) & (RainHazard_aux == 4)
-        hazard_aux = np.where(mask, 15, hazard_aux)
-        mask = (susc_da == 5) & (RainHazard_aux == 5)
-        hazard_aux = np.where(mask, 20, hazard_aux)
-        
-        # Save to file
-        folder_out = self.path_out / self.mode / "Hazard"
-        if not folder_out.exists(): # Create the folder if it doesn't exist
-            folder_out.mkdir(parents=True, exist_ok=True)
-        
-        prefix = file_name1.split('_')[0]
+        # Susceptibility and rainfall hazard classes as indices of the hazard matrix.
+        # No data values are set to class 0 (no hazard). No data susceptibility is 
+        # masked again in place at the end.
+        susc_aux = np.asarray(susc_da)
+        if nan_mask is None:
+            nan_mask = np.isnan(susc_aux)
+        nan_mask = nan_mask | (susc_aux < 0) | (susc_aux >= self.LUT.shape[0])
+        with np.errstate(invalid = "ignore"): # nan cells are overwritten below
+            susc_u8 = susc_aux.astype(np.uint8)
+        susc_u8[nan_mask] = 0
+        rain_u8 = np.where(RainHazard_aux == NODATA, 0, RainHazard_aux)
+        
+        # Look up hazard in the hazard matrix
+        hazard_aux = self.LUT[susc_u8, rain_u8]
+        hazard_aux[nan_mask] = NODATA
         
-        file_save_name = prefix + "_Hazard.tif"
-        file_save = folder_out / file_save_name
+        return(hazard_aux)
+    
+    def ComputeFusedHazard(self, MeanRain, StdRain, acum24, susc_da, susc_nodata=np.nan, out=None):
+        """
+        Implements the normalization of the rain, the computation of the rainfall hazard and
+        of the hazard matrix in a single pass with numba.
+            INPUT:
+                -MeanRain, StdRain: arrays with mean and standard deviation of the 24h rainfall acummulations
+                -acum24: array with the event 24h rainfall acummulations
+                -susc_da, Susceptibility map array in its native dtype
+                -susc_nodata: no data value of the susceptibility map (np.nan if none)
+                -out: (optional) tuple of two uint8 arrays with the shape of susc_da, where the 
+                    rainfall hazard and the hazard are stored. New arrays are allocated if None.
+        """
+        susc_aux = np.asarray(susc_da)
+        if out is None:
+            RainHazard_aux = np.empty(susc_aux.shape, dtype = np.uint8)
+            hazard_aux = np.empty(susc_aux.shape, dtype = np.uint8)
+        else:
+            RainHazard_aux, hazard_aux = out
         
-        # Save Rain Hazard raster
-        outfile = file_save
-        with rasterio.open(outfile, "w", **kwds) as dst_dataset:
-            dst_dataset.write(hazard_aux, 1)
+        _hazard_kernel(acum24, MeanRain, StdRain, susc_aux, susc_nodata, self.I_lim, self.LUT, 
+                       RainHazard_aux, hazard_aux)
         
-        return(hazard_aux)
+        return(RainHazard_aux, hazard_aux)
     
-    def CompGiriHazard(self, file_susc, file_name1, sema=None):
+    def ReadBlock(self, src_susc, InRain, MeanRain_src, StdRain_src, window, ovr=1):
         """
-        Implements different steps for hazard computation. 
+        Reads the input arrays of one block of the output grid. The susceptibility map is read in
+        its native dtype, the rainfall arrays as float32 (no data as np.nan).
             INPUT:
-            -file_susc: file of the susceptibility map
-            -file_name1: name of he susceptibility map sheet
+                -src_susc: opened susceptibility map (ovr > 1) or cached susceptibility array (ovr == 1)
+                -InRain: rainfall acummulation array (memory-mapped) matched to the output grid (None if mode == constant)
+                -MeanRain_src, StdRain_src: mean and sd arrays (memory-mapped) matched to the output grid
+                -window: rasterio Window of the output grid
+                -ovr: ratio between the output grid and the susceptibility map cell sizes
         """
-        # read susceptibility raster 
-        susc, ncols, nrows, kwds, bbox, dx, crs = self.read_susceptibility_classified(file_susc)
+        # read susceptibility block covering the output block
+        if ovr > 1:
+            susc_window = Window(window.col_off * ovr, window.row_off * ovr, 
+                                 window.width * ovr, window.height * ovr)
+            susc = src_susc.read(1, window = susc_window, out_shape = (window.height, window.width))
+        else:
+            susc = np.array(src_susc[window.toslices()])
         
-        # Check if we use constant user-defined rain or an input rainfall map.
         if self.mode == "constant":
             # Create rainfall grid.
-            acum24 = self.CreateCntRain(ncols, nrows)
+            acum24 = self.CreateCntRain(window.width, window.height)
         if self.mode == "map":
-            # Read rainfall acummulation map
-            acum24 = self.ReadInRainMap(susc, crs) 
+            # Read rainfall acummulations. No negative rainfall acummulations.
+            acum24 = np.array(InRain[window.toslices()])
+            acum24[acum24 < 0] = np.nan
         
-        # Compute mean and sd to normalize rain.
-        MeanRain, StdRain = self.OpenRainNorm(susc, crs)
-
-        # Normalize rain.
-        I24norm = self.ComputeRainCnt(MeanRain, StdRain, acum24)
+        # Read mean and sd to normalize rain.
+        MeanRain = np.array(MeanRain_src[window.toslices()])
+        StdRain = np.array(StdRain_src[window.toslices()])
+        
+        return(susc, acum24, MeanRain, StdRain)
+    
+    def OutputProfile(self, susc_profile):
+        """
+        Returns the profile of the output rasters for a susceptibility map. If OVERVIEW_LEVEL > 1
+        the output grid is OVERVIEW_LEVEL times coarser. Edge cells not covering a full coarse 
+        cell are dropped.
+            INPUT:
+                -susc_profile: profile of the susceptibility map
+        """
+        kwds = dict(susc_profile)
+        kwds.update(OUT_PROFILE)
+        
+        ovr = self.OVERVIEW_LEVEL
+        if ovr > 1:
+            kwds.update(width = susc_profile["width"] // ovr,
+                        height = susc_profile["height"] // ovr,
+                        transform = susc_profile["transform"] * Affine.scale(ovr))
+        
+        return(kwds)
+    
+    def PrepareInputs(self, files):
+        """
+        Reprojects the rainfall rasters once for each unique output grid of the susceptibility
+        maps, before they are processed in parallel. The workers then read the cached grids.
+            INPUT:
+                -files: files of the susceptibility maps
+        """
+        grids = {}
+        for file_susc in files:
+            try:
+                with rasterio.open(file_susc) as src_susc:
+                    kwds = self.OutputProfile(src_susc.profile)
+            except rasterio.errors.RasterioIOError:
+                continue # reported when the map is processed, the other maps are not stopped
+            key = (kwds["crs"].to_wkt(), tuple(kwds["transform"]), kwds["width"], kwds["height"])
+            grids.setdefault(key, kwds)
+        
+        print("Preparing rainfall data for {} grids".format(len(grids)))
+        for kwds in grids.values():
+            self.OpenRainNorm(kwds)
+            if self.mode == "map":
+                self.ReadInRainMap(kwds)
+    
+    def OutputFile(self, file_name1, folder_name):
+        """
+        Returns the output file ../Results/{mode}/{folder_name}/{prefix}_{folder_name}.tif
+            INPUT:
+                -file_name1, input name of he susceptibility map sheet
+                -folder_name, name of the output folder (RainHazard/Hazard)
+        """
+        prefix = file_name1.split('_')[0]
+        
+        file_save_name = prefix + "_" + folder_name + ".tif"
+        
+        return(self.path_out / self.mode / folder_name / file_save_name)
+    
+    def OutputFiles(self, file_name1):
+        """
+        Returns the output files of a susceptibility map.
+            INPUT:
+                -file_name1, input name of he susceptibility map sheet
+        """
+        folder_names = ["RainHazard", "Hazard"] if self.SAVE_RAIN_HAZARD else ["Hazard"]
         
-        # Compute rainfall hazard.
-        print("Computing rainfall hazard")
-        RainHazard = self.ComputeRainHazard(I24norm, self.I_lim, file_name1, ncols, nrows, kwds)
+        return([self.OutputFile(file_name1, folder_name) for folder_name in folder_names])
+    
+    def InputFiles(self):
+        """
+        Returns the input files, other than the susceptibility maps, that the outputs depend on.
+        """
+        files = super().InputFiles()
+        files += [self.path_data / "MeanMaxDayRain.asc", self.path_data / "StdMaxDayRain.txt"]
+        if self.mode == "map":
+            files.append(self.path_data / (self.name_in_rain + ".tif"))
         
-        # Compute landslide hazard.
-        print("Computing hazard")
-        LandsHazard = self.ComputeHazard(susc, RainHazard, file_name1, kwds)
+        return(files)
+    
+    def OpenOutRaster(self, file_name1, folder_name, kwds):
+        """
+        Opens an output raster for writing as ../Results/{mode}/{folder_name}/{prefix}_{folder_name}.tif
+            INPUT:
+                -file_name1, input name of he susceptibility map sheet
+                -folder_name, name of the output folder (RainHazard/Hazard)
+                -kwds
+        """
+        file_save = self.OutputFile(file_name1, folder_name)
+        if not file_save.parent.exists(): # Create the folder if it doesn't exist
+            file_save.parent.mkdir(parents=True, exist_ok=True)
         
-        if sema is not None: 
-            sema.release() # Release will add 1 to sema.
+        return(rasterio.open(file_save, "w", **kwds))
+    
+    def CompGiriHazard(self, file_susc, file_name1):
+        """
+        Implements different steps for hazard computation. 
+        The susceptibility map is processed block by block (internal blocks of the .tif), so that
+        only one block of each raster is held in memory. The next block is read while the current
+        one is computed.
+        At full resolution the susceptibility map is read from its .npy cache (see 
+        _load_raster_cached). If OVERVIEW_LEVEL > 1 the hazard is computed on a grid 
+        OVERVIEW_LEVEL times coarser, read from the overviews of the susceptibility map.
+            INPUT:
+            -file_susc: file of the susceptibility map
+            -file_name1: name of he susceptibility map sheet
+        """
+        ovr = self.OVERVIEW_LEVEL
+        if ovr > 1:
+            self._ensure_overviews(file_susc)
+        
+        with ExitStack() as stack:
+            # Incomplete outputs are removed on error, so that they are not taken as up to date.
+            # Only the outputs opened here are removed, outputs of earlier runs are kept if the
+            # error happens before they are opened.
+            files_opened = []
+            def remove_outputs(exc_type, exc, tb):
+                if exc_type is not None:
+                    for file_out in files_opened:
+                        file_out.unlink(missing_ok = True)
+            stack.push(remove_outputs)
+            
+            print("Reading data: {}".format(file_susc))
+            if ovr > 1:
+                # open susceptibility raster, read from its overviews
+                src_susc = stack.enter_context(rasterio.open(file_susc))
+                kwds = self.OutputProfile(src_susc.profile)
+            else:
+                # susceptibility map at full resolution, cached decompressed as .npy
+                src_susc, susc_profile = self._load_raster_cached(file_susc)
+                kwds = self.OutputProfile(susc_profile)
+            
+            # No data value of the susceptibility map, which is read in its native dtype
+            susc_nodata = src_susc.nodata if ovr > 1 else susc_profile["nodata"]
+            if susc_nodata is None:
+                susc_nodata = np.nan
+            
+            # Check if we use constant user-defined rain or an input rainfall map.
+            InRain = None
+            if self.mode == "map":
+                # Open rainfall acummulation map
+                InRain = self.ReadInRainMap(kwds)
+            
+            # Open mean and sd to normalize rain.
+            MeanRain_src, StdRain_src = self.OpenRainNorm(kwds)
+            
+            # Open output rasters. The rainfall hazard is only written if requested.
+            dst_rain = None
+            if self.SAVE_RAIN_HAZARD:
+                files_opened.append(self.OutputFile(file_name1, "RainHazard"))
+                dst_rain = stack.enter_context(self.OpenOutRaster(file_name1, "RainHazard", kwds))
+            files_opened.append(self.OutputFile(file_name1, "Hazard"))
+            dst_haz = stack.enter_context(self.OpenOutRaster(file_name1, "Hazard", kwds))
+            
+            print("Computing rainfall hazard and hazard")
+            windows = self.BlockWindows(dst_haz)
+            # Output buffers, reused for every block. Flat, so that views of any block shape are
+            # contiguous. Each block is written before the next one is computed.
+            block_size = max(window.height * window.width for window in windows)
+            rain_buffer = np.empty(block_size, dtype = np.uint8)
+            haz_buffer = np.empty(block_size, dtype = np.uint8)
+            # The next block is read in a thread while the current one is computed and written.
+            reader = stack.enter_context(ThreadPoolExecutor(max_workers = 1))
+            next_block = reader.submit(self.ReadBlock, src_susc, InRain, MeanRain_src, StdRain_src, 
+                                       windows[0], ovr)
+            for ii, window in enumerate(windows):
+                susc, acum24, MeanRain, StdRain = next_block.result()
+                if ii + 1 < len(windows):
+                    next_block = reader.submit(self.ReadBlock, src_susc, InRain, MeanRain_src, 
+                                               StdRain_src, windows[ii + 1], ovr)
+                
+                # Output buffers of the block
+                ncells = window.height * window.width
+                RainHazard_out = rain_buffer[:ncells].reshape(window.height, window.width)
+                LandsHazard_out = haz_buffer[:ncells].reshape(window.height, window.width)
+                
+                if NUMBA_AVAILABLE:
+                    # Normalize rain, compute rainfall hazard and landslide hazard in one pass.
+                    RainHazard, LandsHazard = self.ComputeFusedHazard(
+                        MeanRain, StdRain, acum24, susc, susc_nodata, 
+                        out = (RainHazard_out, LandsHazard_out))
+                else:
+                    # Normalize rain. acum24 of the block is reused as buffer if it is an array
+                    # (mode == map), not a broadcast constant (mode == constant).
+                    out = acum24 if acum24.flags.writeable else None
+                    I24norm = self.ComputeRainCnt(MeanRain, StdRain, acum24, out = out)
+                    
+                    # No data cells, scanned once and passed to each step.
+                    rain_nan = np.isnan(I24norm)
+                    susc_nan = np.isnan(susc) | (susc == susc_nodata)
+                    
+                    # Compute rainfall hazard.
+                    RainHazard = self.ComputeRainHazard(I24norm, self.I_lim, nan_mask = rain_nan, 
+                                                        out = RainHazard_out)
+                    
+                    # Compute landslide hazard.
+                    LandsHazard = self.ComputeHazard(susc, RainHazard, nan_mask = susc_nan)
+                
+                # Save block of the Rain Hazard and Hazard rasters
+                if dst_rain is not None:
+                    dst_rain.write(RainHazard, 1, window = window)
+                dst_haz.write(LandsHazard, 1, window = window)
+        
+        # Cloud-Optimized GeoTIFF outputs, once the rasters are closed
+        if self.COG:
+            for dst in (dst_rain, dst_haz):
+                if dst is not None:
+                    self.SaveAsCOG(dst.name)
     
 if __name__ == '__main__':
     CalcHazard(**KWARGS)
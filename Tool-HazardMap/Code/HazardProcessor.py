@@ -7,19 +7,132 @@ Rosa M Palau (NGI)     08.04.2024
 """
 import numpy as np
 import pandas as pd
+import rasterio
+from rasterio.crs import CRS
+from rasterio.windows import Window
+from affine import Affine
 
 from pathlib import Path
-from multiprocessing import Process, Semaphore
-import cProfile
-import pstats
+import os
+import sys
+import pickle
+import json
+import hashlib
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from abc import ABC, abstractmethod
 
+try:
+    from numba import njit, prange, set_num_threads
+    NUMBA_AVAILABLE = True
+except ImportError: # numba is optional. Hazard is then computed step by step with numpy.
+    NUMBA_AVAILABLE = False
+    prange = range
+    def njit(*args, **kwargs):
+        return(lambda func: func)
+
+try:
+    from rio_cogeo.cogeo import cog_translate
+    from rio_cogeo.profiles import cog_profiles
+    COGEO_AVAILABLE = True
+except ImportError: # rio-cogeo is optional. Outputs are then saved as tiled GeoTIFFs.
+    COGEO_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# No data value of the output rasters
+NODATA = 255
+
+# Processor of a pool worker, set once per worker by _init_worker
+_worker_processor = None
+# Profiler of a pool worker, only set if PROFILE is True
+_worker_profiler = None
+
+def _init_worker(processor):
+    """
+    Pool initializer. Keeps the processor in the worker, so that tasks only carry the file names.
+    The numba threads are split between the workers, so that the workers do not oversubscribe
+    the CPUs.
+    """
+    global _worker_processor, _worker_profiler
+    _worker_processor = processor
+    if NUMBA_AVAILABLE:
+        set_num_threads(max(1, processor.n_cpus // processor.MAX_NUMBER_OF_PROCESSES))
+    if processor.PROFILE:
+        import cProfile # only imported if needed
+        _worker_profiler = cProfile.Profile()
+
+def _run_worker(file_susc, file_name1):
+    """
+    Pool task. Runs CompGiriHazard of the worker processor for one susceptibility map.
+    If PROFILE is True the task is profiled. The stats of all the tasks of the worker are saved
+    in ../Results/profile_{pid}.prof after each task, as the pool does not notify worker exits.
+    """
+    if _worker_profiler is None:
+        return(_worker_processor.CompGiriHazard(file_susc, file_name1))
+    
+    _worker_profiler.enable()
+    try:
+        return(_worker_processor.CompGiriHazard(file_susc, file_name1))
+    finally:
+        _worker_profiler.disable()
+        _worker_profiler.dump_stats(_worker_processor.path_out / "profile_{}.prof".format(os.getpid()))
+
+# fastmath without the "nnan"/"ninf" flags, so that nan checks are kept.
+# nogil, so that the next block can be read while the kernel runs.
+@njit(parallel = True, nogil = True, fastmath = {"nsz", "arcp", "contract", "afn", "reassoc"}, cache = True)
+def _hazard_kernel(acum24, mean, std, susc, susc_nodata, Ilim, LUT, rain_out, haz_out):
+    """
+    Normalizes the rainfall, computes the rainfall hazard and the hazard in a single pass.
+    Shared hazard kernel for the subclasses, used by CompGiriHazard when numba is installed.
+        INPUT:
+            -acum24, mean, std: 24h rainfall acummulations, mean and standard deviation arrays
+            -susc: susceptibility map array, any dtype
+            -susc_nodata: no data value of susc (np.nan if none)
+            -Ilim: limits of the rainfall hazard classes
+            -LUT: hazard matrix
+            -rain_out, haz_out: uint8 output arrays for the rainfall hazard and hazard (NODATA if no data)
+    """
+    nrows, ncols = susc.shape
+    nlim = Ilim.shape[0]
+    for ii in prange(nrows):
+        for jj in range(ncols):
+            # Normalize rain
+            I24norm = (acum24[ii, jj] - mean[ii, jj]) / std[ii, jj]
+            
+            # Rainfall hazard: class kk + 1 for Ilim[kk-1] < I24norm <= Ilim[kk]
+            if np.isnan(I24norm):
+                rain_class = 0
+                rain_out[ii, jj] = NODATA
+            else:
+                lo = 0
+                hi = nlim
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if Ilim[mid] < I24norm:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                rain_class = lo + 1
+                rain_out[ii, jj] = rain_class
+            
+            # Hazard
+            susc_class = susc[ii, jj]
+            if (susc_class == susc_nodata or np.isnan(susc_class) 
+                or susc_class < 0 or susc_class >= LUT.shape[0]):
+                haz_out[ii, jj] = NODATA
+            else:
+                haz_out[ii, jj] = LUT[int(susc_class), rain_class]
+
+
 class HazardProcessor(ABC):
     def __init__(self, **kwargs):
         """
         Runs the script by calling multi_process_rasters or process_raster according to the
-        boolean variable MULTIPROCESSING. It also creates an output folder, and adds a
-        profiler and a file handler to logger.
+        boolean variable MULTIPROCESSING. It also creates an output folder. If PROFILE is True
+        the run is profiled with cProfile. With MULTIPROCESSING, only the pool workers are 
+        profiled, each worker saves its own stats (see _run_worker).
         """
         # paths
         self.path_bas = Path().resolve().parent
@@ -28,89 +141,355 @@ class HazardProcessor(ABC):
         # projection
         self.epsg_wgs84 = kwargs["epsg_wgs84"]
         
-        # classes
-        self.sclass = kwargs["sclass"]
-        self.I_lim = kwargs["I_lim"]
+        # classes. Converted once to contiguous arrays, used as they are by the classification
+        self.sclass = np.ascontiguousarray(kwargs["sclass"], dtype = np.uint8)
+        self.I_lim = np.ascontiguousarray(kwargs["I_lim"], dtype = np.float32)
         
         # read user-defined parameters from excel file
-        inparam_file = self.path_data / "input_variables.xlsx"
-        df = pd.read_excel(inparam_file, header = None)
-        UserParam = dict(zip(df[0], df[1]))
+        self.inparam_file = self.path_data / "input_variables.xlsx"
+        UserParam = self._load_user_params(self.inparam_file)
         self.mode = UserParam["mode"]
         
         if UserParam["mode"] == "constant":
-            self.in_acum = np.float32(UserParam["input rain"])
+            # Scalar, broadcast against the rasters (never expanded to a full raster)
+            try:
+                self.in_acum = np.float32(float(UserParam["input rain"]))
+            except (TypeError, ValueError):
+                raise ValueError("input rain must be a number, got {!r}".format(UserParam["input rain"]))
+            if not np.isfinite(self.in_acum) or self.in_acum < 0:
+                raise ValueError("input rain must be a non-negative number, got {}".format(self.in_acum))
         if UserParam["mode"] == "map":
             self.name_in_rain = UserParam["input rain map name"]
     
         # Multiprocess param
         self.MULTIPROCESSING = kwargs['MULTIPROCESSING']
         self.MAX_NUMBER_OF_PROCESSES = kwargs['MAX_NUMBER_OF_PROCESSES']
+        # No more processes than CPUs available to this process (e.g. capped in a container)
+        if hasattr(os, "sched_getaffinity"):
+            self.n_cpus = len(os.sched_getaffinity(0))
+        else:
+            self.n_cpus = os.cpu_count() or 1
+        if self.MAX_NUMBER_OF_PROCESSES > self.n_cpus:
+            if self.MULTIPROCESSING:
+                logger.warning("MAX_NUMBER_OF_PROCESSES = %s exceeds the %s available CPUs, using %s",
+                               self.MAX_NUMBER_OF_PROCESSES, self.n_cpus, self.n_cpus)
+            self.MAX_NUMBER_OF_PROCESSES = self.n_cpus
         
         # Check if the folder for output files exists. Create it if not.
         self.path_out = self.path_bas / "Results"
         if not self.path_out.exists():
             self.path_out.mkdir(parents=True, exist_ok=True)
         
-        # # Create profiler
-        # profiler = cProfile.Profile()
-        # profiler.enable()
-
-        # Run script
+        # Save outputs as Cloud-Optimized GeoTIFFs (requires rio-cogeo)
+        self.COG = kwargs.get('COG', False)
+        if self.COG and not COGEO_AVAILABLE:
+            logger.warning("rio-cogeo is not installed, outputs are saved as tiled GeoTIFFs")
+            self.COG = False
+        if self.COG:
+            self.cog_profile = cog_profiles.get("deflate")
+            self.cog_profile.update(blockxsize = 512, blockysize = 512, predictor = 2)
+        
+        # Susceptibility maps, listed on first use
+        self._sus_files = None
+        # Skip maps whose outputs are newer than all inputs
+        self.SKIP_UP_TO_DATE = kwargs.get('SKIP_UP_TO_DATE', False)
+        
+        # Profile the run (cProfile), stats saved in ../Results/profile_{pid}.prof. With 
+        # MULTIPROCESSING one file for each pool worker
+        self.PROFILE = kwargs.get('PROFILE', False)
+        
+        # Run script. With MULTIPROCESSING the main process is not profiled: the workers are 
+        # forked from it and a profiler active there blocks their own (Python >= 3.12).
+        if self.PROFILE and not self.MULTIPROCESSING:
+            import cProfile # only imported if needed
+            with cProfile.Profile() as profiler:
+                self._run()
+            profiler.dump_stats(self.path_out / "profile_{}.prof".format(os.getpid()))
+        else:
+            self._run()
+    
+    def _run(self):
+        """
+        Calls multi_process_rasters or process_rasters according to MULTIPROCESSING.
+        """
         if self.MULTIPROCESSING:
             self.multi_process_rasters()
         else:
             self.process_rasters()
-
-        # profiler.disable()
+    
+    def _load_user_params(self, inparam_file):
+        """
+        Reads the user-defined parameters (two columns: name, value) from the excel file as a dict.
+        The dict is cached as a pickle in the ../Data/.cache/ folder, keyed by the hash of the 
+        file content, so the excel file is only parsed again when it changes. Older versions of
+        the cache are removed.
+            INPUT:
+                -inparam_file: excel file with the user-defined parameters
+        """
+        key = hashlib.blake2b(inparam_file.read_bytes(), digest_size = 16).hexdigest()
+        folder_cache = self.path_data / ".cache"
+        file_cache = folder_cache / "{}_{}.pkl".format(inparam_file.stem, key)
+        if file_cache.exists():
+            with open(file_cache, "rb") as f:
+                return(pickle.load(f))
+        
+        try:
+            df = pd.read_excel(inparam_file, header = None, engine = "calamine")
+        except (ImportError, ValueError): # python-calamine not installed or pandas < 2.2
+            df = pd.read_excel(inparam_file, header = None, engine = "openpyxl")
+        UserParam = dict(zip(df[0], df[1]))
+        
+        # Written to a temporary file first, other processes may build the same cache.
+        folder_cache.mkdir(parents=True, exist_ok=True)
+        file_tmp = file_cache.with_suffix(".{}.tmp".format(os.getpid()))
+        with open(file_tmp, "wb") as f:
+            pickle.dump(UserParam, f)
+        os.replace(file_tmp, file_cache)
+        # Older versions of the parameters
+        self._remove_stale_cache(file_cache, "{}_{}.pkl".format(inparam_file.stem, "?" * len(key)), (".pkl",))
+        
+        return(UserParam)
+    
+    def _load_raster_cached(self, path):
+        """
+        Returns band 1 of a raster in its native dtype and its profile (with the no data value).
+        The decompressed raster is cached as a .npy file, with the profile as a .json sidecar, in
+        the ../Data/.cache/ folder, keyed by the path, size and modification time of the raster.
+        The array is opened as read-only memory-mapped, so processes share it via the page cache.
+            INPUT:
+                -path: file of the raster
+        """
+        stat = os.stat(path)
+        key = repr((str(path), stat.st_size, stat.st_mtime_ns))
+        digest = hashlib.blake2b(key.encode(), digest_size = 8).hexdigest()
+        
+        folder_cache = self.path_data / ".cache"
+        file_cache = folder_cache / "{}_{}.npy".format(path.stem, digest)
+        file_profile = file_cache.with_suffix(".json")
+        if not file_cache.exists():
+            folder_cache.mkdir(parents=True, exist_ok=True)
+            # Written to temporary files first, other processes may build the same cache. 
+            # The .npy is written last, so that it only exists with its .json.
+            file_tmp = file_cache.with_suffix(".{}.tmp".format(os.getpid()))
+            with rasterio.open(path) as src_dataset:
+                profile = dict(src_dataset.profile)
+                
+                # crs and transform as text/list in the .json
+                profile["crs"] = profile["crs"].to_wkt() if profile.get("crs") else None
+                profile["transform"] = list(profile["transform"])[:6]
+                with open(file_tmp, "w") as f:
+                    json.dump(profile, f)
+                os.replace(file_tmp, file_profile)
+                
+                self._save_npy_by_strips(file_tmp, (src_dataset.height, src_dataset.width), 
+                                         src_dataset.dtypes[0], 
+                                         lambda window: src_dataset.read(1, window = window))
+            os.replace(file_tmp, file_cache)
+            
+            # Older versions of the cache of this raster
+            self._remove_stale_cache(file_cache, "{}_{}.npy".format(path.stem, "?" * len(digest)), 
+                                     (".npy", ".json"))
+        
+        raster = np.load(file_cache, mmap_mode = "r")
+        with open(file_profile) as f:
+            profile = json.load(f)
+        profile["crs"] = CRS.from_wkt(profile["crs"]) if profile["crs"] else None
+        profile["transform"] = Affine(*profile["transform"])
+        
+        return(raster, profile)
+    
+    def _save_npy_by_strips(self, file_npy, shape, dtype, read_window, strip_height=512):
+        """
+        Saves a raster as a .npy file strip by strip (strip_height rows), so that the full raster
+        is never held in memory. The .npy header is created with open_memmap, the strips are 
+        written with plain file writes (no mapped pages).
+            INPUT:
+                -file_npy: .npy file to write
+                -shape: (nrows, ncols) of the raster
+                -dtype: dtype of the .npy
+                -read_window: function returning the array of a rasterio Window of the raster
+                -strip_height: number of rows read and written at once
+        """
+        raster = np.lib.format.open_memmap(file_npy, mode = "w+", dtype = dtype, shape = shape)
+        offset = raster.offset
+        del raster
+        
+        nrows, ncols = shape
+        row_bytes = ncols * np.dtype(dtype).itemsize
+        with open(file_npy, "r+b") as f:
+            for row_off in range(0, nrows, strip_height):
+                window = Window(0, row_off, ncols, min(strip_height, nrows - row_off))
+                f.seek(offset + row_off * row_bytes)
+                np.ascontiguousarray(read_window(window), dtype = dtype).tofile(f)
+    
+    def _remove_stale_cache(self, file_cache, pattern, suffixes=(".npy",)):
+        """
+        Removes the files of the ../Data/.cache/ folder that match pattern, except file_cache.
+        Used to remove older versions of a cache once a new version is written.
+            INPUT:
+                -file_cache: current cache file (kept)
+                -pattern: glob pattern of the cache files of the same raster
+                -suffixes: suffixes of the files of a cache entry (e.g. the .json sidecar)
+        """
+        for file_old in file_cache.parent.glob(pattern):
+            if file_old == file_cache:
+                continue
+            for suffix in suffixes:
+                file_old.with_suffix(suffix).unlink(missing_ok = True)
+    
+    def _discover_sus_files(self):
+        """
+        Returns the susceptibility maps (files that end with '_sus.tif') in the Data folder,
+        sorted by name. The folder is only listed once, the list is kept in self._sus_files.
+        """
+        if self._sus_files is None:
+            self._sus_files = sorted(self.path_data.glob('*_sus.tif'))
+            if len(self._sus_files) == 0:
+                logger.warning("No susceptibility maps (*_sus.tif) found in %s", self.path_data)
+        
+        return(self._sus_files)
+    
+    def _pending_sus_files(self):
+        """
+        Returns the susceptibility maps to process. If SKIP_UP_TO_DATE is True, the maps whose
+        outputs are up to date (see _is_up_to_date) are left out.
+        """
+        files = self._discover_sus_files()
+        if not self.SKIP_UP_TO_DATE:
+            return(files)
+        
+        pending = []
+        for file_susc in files:
+            if self._is_up_to_date(file_susc):
+                print("Outputs up to date, skipped: {}".format(file_susc))
+            else:
+                pending.append(file_susc)
+        
+        return(pending)
+    
+    def _is_up_to_date(self, file_susc):
+        """
+        True if all outputs (OutputFiles) of a susceptibility map exist and are newer than the 
+        map and the other input files (InputFiles).
+        :param file_susc: Path to the susceptibility map.
+        """
+        files_out = self.OutputFiles(file_susc.stem)
+        if not files_out:
+            return(False)
+        
+        files_in = [file_susc] + [f for f in self.InputFiles() if f.exists()]
+        t_in = max(f.stat().st_mtime for f in files_in)
+        
+        return(all(f.exists() and f.stat().st_mtime > t_in for f in files_out))
     
     def multi_process_rasters(self):
         """
         Calls CompGiriHazard for each susceptibility map in the Data folder
-        by spawning multiple processes.
+        in a pool of MAX_NUMBER_OF_PROCESSES processes. The maps are independent,
+        so they are processed concurrently. Maps that fail are logged and reported at the end.
         """
-        # Find files that end with '_sus.tif'
-        files = list(self.path_data.glob('*_sus'))
+        files = self._pending_sus_files()
         
-        processes = []
-        sema = Semaphore(self.MAX_NUMBER_OF_PROCESSES)
+        # Shared inputs are prepared once here, not in every worker.
+        self.PrepareInputs(files)
         
-        for file_susc in files:
-                sema.acquire() # Subtract 1 from sema. Block if allready empty.
-                
+        # fork on Linux: workers inherit the parsed parameters instead of initializing again.
+        # Other platforms only support spawn safely.
+        if sys.platform.startswith("linux"):
+            mp_context = multiprocessing.get_context("fork")
+        else:
+            mp_context = multiprocessing.get_context("spawn")
+        
+        # The processor is passed once per worker (initializer), tasks only carry the file names.
+        with ProcessPoolExecutor(max_workers = self.MAX_NUMBER_OF_PROCESSES, 
+                                 mp_context = mp_context, initializer = _init_worker,
+                                 initargs = (self,)) as executor:
+            futures = {}
+            for file_susc in files:
                 # Get name of the raster file
-                file_name = Path(file_susc).name
-                file_name1 = Path(file_susc).stem
-                
-                p = Process(target=self.CompGiriHazard,
-                            args=(file_susc, file_name1, sema)) ## check
-                p.start()
-                processes.append(p)
-        
-                # Finish one group at the time.
-                for p in processes:
-                    p.join()
+                file_name1 = file_susc.stem
+                futures[executor.submit(_run_worker, file_susc, file_name1)] = file_susc
+            
+            # Collect the maps as they finish. A failed map does not stop the other maps.
+            failed = []
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception("Hazard computation failed for %s", futures[future])
+                    failed.append(futures[future])
+        
+        if failed:
+            raise RuntimeError("Hazard computation failed for {} of {} maps: {}".format(
+                len(failed), len(files), ", ".join(str(f) for f in failed)))
 
     def process_rasters(self):
         """
         Calls CompGiriHazard for each susceptibility map in the Data folder.
         """
-        # Find files that end with '_sus.tif'
-        files = list(self.path_data.glob('*_sus.tif'))
+        files = self._pending_sus_files()
         
         for file_susc in files:
-                # Get name of the raster file
-                file_name = Path(file_susc).name
-                file_name1 = Path(file_susc).stem
-                self.CompGiriHazard(file_susc = file_susc, file_name1 = file_name1)
+            # Get name of the raster file
+            file_name1 = file_susc.stem
+            self.CompGiriHazard(file_susc = file_susc, file_name1 = file_name1)
                 
+    def SaveAsCOG(self, file_out):
+        """
+        Rewrites an output raster as Cloud-Optimized GeoTIFF (internal 512x512 tiles, overviews,
+        DEFLATE compression) with self.cog_profile. Overviews use mode resampling, the outputs
+        are classes.
+        :param file_out: Path to the output raster, replaced by the COG.
+        """
+        file_out = Path(file_out)
+        file_tmp = file_out.with_suffix(".cog.tmp")
+        cog_translate(file_out, file_tmp, self.cog_profile, overview_resampling = "mode", 
+                      in_memory = False, quiet = True)
+        os.replace(file_tmp, file_out)
+    
+    def BlockWindows(self, dataset):
+        """
+        Returns the windows of the internal blocks (tiles) of band 1 of a raster, to process it
+        block by block. Peak memory is then a few blocks per process, not the full raster.
+        :param dataset: Opened raster (rasterio dataset).
+        """
+        return([window for _, window in dataset.block_windows(1)])
+    
+    def InputFiles(self):
+        """
+        Returns the input files, other than the susceptibility maps, that the outputs depend on.
+        May be extended in a subclass.
+        """
+        return([self.inparam_file])
+    
+    def OutputFiles(self, file_name1):
+        """
+        Returns the output files of a susceptibility map. Needs to be implemented in a subclass
+        for SKIP_UP_TO_DATE, maps are never skipped otherwise.
+        :param file_name1: Name of the susceptibility map sheet.
+        """
+        return([])
+    
+    def PrepareInputs(self, files):
+        """
+        Called once in the main process before the susceptibility maps are processed in 
+        parallel. May be implemented in a subclass to prepare inputs shared by the maps.
+        :param files: Paths to the susceptibility maps.
+        """
+        pass
+    
     @abstractmethod
-    def CompGiriHazard(self, file_susc, file_name1, sema=None):
+    def CompGiriHazard(self, file_susc, file_name1):
         """
         Calls successive operations on input_rasters. May be edited to include other operations.
-        :param output_dir: Directory to place folder for output from methods.
-        :param input_raster: Path to DEM for processing.
-        :sema: Semapore (to limit number of processes).
+        :param file_susc: Path to the susceptibility map for processing.
+        :param file_name1: Name of the susceptibility map sheet.
+        In mode "constant" the rainfall self.in_acum is a np.float32 scalar. It should be used
+        through broadcasting, not expanded into a raster-sized array. The class limits 
+        self.I_lim are a contiguous float32 array, to be used directly in vectorized 
+        classifications (np.searchsorted/np.digitize). Output rasters are written under 
+        self.path_out and, if self.COG is True, converted with SaveAsCOG once closed. Rasters
+        should be processed by window (see BlockWindows), not read as full arrays.
         """
         # This part needs to be implemented in subclass.
         pass 
\ No newline at end of file